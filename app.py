@@ -1,10 +1,22 @@
 # app.py
 import os
-from flask import Flask, render_template, request, redirect, url_for, session, flash, abort
-from sqlalchemy import create_engine, Column, Integer, String, Text, select
-from sqlalchemy.orm import declarative_base, Session as OrmSession
+import hashlib
+import hmac
+import json
+import secrets
+from functools import lru_cache, wraps
+import redis
+from flask import Flask, g, get_flashed_messages, render_template, stream_template, request, redirect, url_for, session, flash, abort
+from sqlalchemy import create_engine, event, Column, Index, Integer, String, Text, delete, select, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import declarative_base, load_only, raiseload, scoped_session, sessionmaker
 from sqlalchemy.exc import OperationalError
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from dotenv import load_dotenv
+from jinja2 import FileSystemBytecodeCache
+from flask_session import Session as ServerSession
 
 load_dotenv()
 
@@ -12,17 +24,65 @@ DATABASE_URL = os.environ.get('DATABASE_URL')
 if not DATABASE_URL:
     raise RuntimeError("Missing DATABASE_URL environment variable. Set it to your Railway Postgres URL.")
 
+# Use the psycopg 3 driver, which can promote repeated queries to server-side
+# prepared statements. Railway hands out plain postgres(ql):// URLs.
+for _scheme in ('postgres://', 'postgresql://'):
+    if DATABASE_URL.startswith(_scheme):
+        DATABASE_URL = 'postgresql+psycopg://' + DATABASE_URL[len(_scheme):]
+        break
+
 # Create engine
-engine = create_engine(DATABASE_URL, echo=False, future=True)
+# Pool sizing is tunable per deployment; keepalives stop Railway's proxy from
+# silently dropping idle pooled sockets.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '25'))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', str(DB_POOL_SIZE)))
+_prepare = os.environ.get('DB_PREPARE_THRESHOLD', '3')
+DB_PREPARE_THRESHOLD = None if _prepare.lower() == 'off' else int(_prepare)
+
+# sslmode: DB_SSLMODE wins, then ?sslmode= in DATABASE_URL, else 'require'.
+# (connect_args override URL query params, so only pass it when needed.)
+ssl_args = {}
+if os.environ.get('DB_SSLMODE'):
+    ssl_args['sslmode'] = os.environ['DB_SSLMODE']
+elif 'sslmode' not in make_url(DATABASE_URL).query:
+    ssl_args['sslmode'] = 'require'
+
+engine = create_engine(
+    DATABASE_URL,
+    echo=False,
+    future=True,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    pool_use_lifo=True,
+    query_cache_size=1200,
+    connect_args={
+        **ssl_args,
+        "keepalives": 1,
+        "keepalives_idle": 30,
+        # PREPARE after the 3rd execution; set DB_PREPARE_THRESHOLD=off behind
+        # PgBouncer in transaction pooling mode, which breaks prepared statements.
+        "prepare_threshold": DB_PREPARE_THRESHOLD,
+    },
+)
+
+# One ORM session per request (see teardown below); objects stay usable in
+# templates after commit.
+db_session = scoped_session(sessionmaker(bind=engine, future=True, expire_on_commit=False))
 
 Base = declarative_base()
 
 # Models mapping to existing tables
 class User(Base):
     __tablename__ = 'users'
+    __table_args__ = (
+        # partial index backing admin-only listings
+        Index('ix_users_admins', 'id', postgresql_where=text("role = 'admin'")),
+    )
     id = Column(Integer, primary_key=True)
-    username = Column(String(150), unique=True, nullable=False)
-    password = Column(String(255), nullable=False)  # currently plaintext in this example
+    username = Column(String(150), unique=True, nullable=False, index=True)
+    password = Column(String(255), nullable=False)  # argon2 hash (legacy rows may still be plaintext)
     fullname = Column(String(255))
     description = Column(Text)
     role = Column(String(20))  # 'admin' or 'user'
@@ -33,42 +93,221 @@ class Notification(Base):
     content = Column(Text)
     note = Column(Text)
 
+# everything a page may show about a user (never the password hash)
+USER_DISPLAY_COLUMNS = (User.id, User.username, User.fullname, User.description, User.role)
+
 # If you want to auto-create tables (only if they don't exist and you want to), uncomment:
 # Base.metadata.create_all(engine)
+# On an existing database username is already covered by the unique index
+# behind users_username_key; only the admin index needs creating:
+#   CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_admins ON users (id) WHERE role = 'admin';
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('FLASK_SECRET', 'notifix_secret_key_12345')
+# Share compiled template bytecode across workers and restarts; without
+# JINJA_CACHE_DIR Jinja picks a private per-user temp directory.
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(os.environ.get('JINJA_CACHE_DIR'))
+
+@app.teardown_appcontext
+def remove_db_session(exc=None):
+    db_session.remove()
+
+# Optional Redis: server-side sessions + notifications list cache.
+# Without REDIS_URL the app keeps signed-cookie sessions and no cache.
+REDIS_URL = os.environ.get('REDIS_URL')
+redis_client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+if redis_client is not None:
+    # SESSION_PERMANENT=False keeps the browser-session cookie of the default
+    # signed-cookie sessions (Flask-Session would otherwise issue 31-day ones)
+    app.config.update(SESSION_TYPE='redis', SESSION_REDIS=redis_client,
+                      SESSION_PERMANENT=False)
+    ServerSession(app)
+
+def _raise_on_lazyload(state):
+    if state.is_select and not state.is_column_load and not state.is_relationship_load:
+        state.statement = state.statement.options(raiseload('*'))
+
+def enable_lazyload_guard():
+    """Development only: make any lazy relationship load (N+1) raise."""
+    if not event.contains(db_session, 'do_orm_execute', _raise_on_lazyload):
+        event.listen(db_session, 'do_orm_execute', _raise_on_lazyload)
+
+if app.debug:
+    enable_lazyload_guard()
+
+NOTIF_LIST_TTL = 60
+NOTIF_VERSION_KEY = 'notif:ver'
+# user_id -> role map consulted by the auth decorators; user_edit/user_delete
+# overwrite entries, cache fills never do (SET NX), so a racing request
+# cannot restore a stale role.
+USER_ROLE_TTL = 30 * 24 * 3600
+DELETED_USER_ROLE = '!deleted'
 
 # --- Helper utilities ---
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
+def hash_password(password: str) -> str:
+    return password_hasher.hash(password)
+
+# Verified against when there is no usable hash, so a failed login costs the
+# same argon2 work whether or not the username exists.
+DUMMY_PASSWORD_HASH = hash_password(secrets.token_urlsafe(16))
+
+def burn_password_check(password: str) -> None:
+    try:
+        password_hasher.verify(DUMMY_PASSWORD_HASH, password)
+    except VerificationError:
+        pass
+
+def verify_password(user, password: str) -> bool:
+    """Check a login attempt (user may be None); upgrades legacy plaintext/outdated hashes in place."""
+    if user is None:
+        burn_password_check(password)
+        return False
+    stored = user.password or ''
+    if stored.startswith('$argon2'):
+        try:
+            password_hasher.verify(stored, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        if password_hasher.check_needs_rehash(stored):
+            user.password = hash_password(password)
+        return True
+    # legacy plaintext row: constant-time compare, then migrate to a hash
+    if not hmac.compare_digest(stored.encode('utf-8'), password.encode('utf-8')):
+        burn_password_check(password)
+        return False
+    user.password = hash_password(password)
+    return True
+
 def get_user_by_username(username: str):
-    with OrmSession(engine) as s:
-        stmt = select(User).where(User.username == username)
-        return s.scalar(stmt)
+    return db_session.scalar(select(User).where(User.username == username))
+
+def fetch_one(stmt):
+    """First row of a read-only column SELECT as a mapping (or None).
+
+    Runs on the request's session connection (the auth check has usually
+    already opened it), so the page holds one connection and builds no ORM
+    objects for a row it only displays.
+    """
+    return db_session.execute(stmt).mappings().first()
+
+def clean(value: str) -> str:
+    """str.strip() that skips the copy when there is nothing to strip."""
+    if value and (value[0].isspace() or value[-1].isspace()):
+        return value.strip()
+    return value
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
 
-def get_user_by_id(user_id: int):
-    with OrmSession(engine) as s:
-        stmt = select(User).where(User.id == user_id)
-        return s.scalar(stmt)
+def page_args():
+    """Keyset pagination args from the query string: ?after=<id>&limit=N."""
+    after = request.args.get('after', type=int)
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    return after, max(1, min(limit, MAX_PAGE_SIZE))
+
+def notifications_version():
+    """Counter bumped on every notification write; None without Redis."""
+    if redis_client is None:
+        return None
+    return int(redis_client.get(NOTIF_VERSION_KEY) or 0)
+
+def iter_notifications_page(after, limit, version=None):
+    """Yield one page of notifications as dicts, from Redis when enabled.
+
+    Rows are streamed from a server-side cursor so the template can render
+    while Postgres is still sending them.
+    """
+    if version is not None:
+        key = f"notif:list:{version}:{after}:{limit}"
+        cached = redis_client.get(key)
+        if cached is not None:
+            yield from json.loads(cached)
+            return
+    # the list only renders id + a content preview; leave note unloaded
+    stmt = (select(Notification)
+            .options(load_only(Notification.id, Notification.content))
+            .order_by(Notification.id.desc()).limit(limit))
+    if after is not None:
+        stmt = stmt.where(Notification.id < after)
+    rows = []
+    for n in db_session.scalars(stmt, execution_options={'yield_per': 100}):
+        row = {'id': n.id, 'content': n.content}
+        rows.append(row)
+        yield row
+    if version is not None:
+        redis_client.set(key, json.dumps(rows), ex=NOTIF_LIST_TTL)
+
+def invalidate_notifications_cache():
+    # bumping the version orphans every cached page; they expire via TTL
+    if redis_client is not None:
+        redis_client.incr(NOTIF_VERSION_KEY)
+
+@lru_cache(maxsize=64)
+def _static_url(endpoint: str, script_root: str) -> str:
+    return url_for(endpoint)
+
+def static_url(endpoint: str) -> str:
+    """url_for() for argument-less routes, memoized per script root."""
+    return _static_url(endpoint, request.script_root)
+
+def current_user():
+    """The logged-in User, loaded at most once per request (None if gone)."""
+    if 'current_user' not in g:
+        user_id = session.get('user_id')
+        g.current_user = db_session.get(User, user_id) if user_id is not None else None
+    return g.current_user
+
+def set_user_role(user_id: int, role) -> None:
+    """Record a role change (or DELETED_USER_ROLE) in the Redis role map."""
+    if redis_client is not None:
+        redis_client.set(f"user:role:{user_id}", role or '', ex=USER_ROLE_TTL)
+
+def current_role():
+    """Role of the logged-in user, or None after dropping a dead session.
+
+    The role is re-read per request (from the Redis role map when enabled,
+    else the database) rather than trusted from login, so demoting or
+    deleting a user takes effect on their next request.
+    """
+    user_id = session.get('user_id')
+    if user_id is None:
+        return None
+    role = None
+    if redis_client is not None:
+        cached = redis_client.get(f"user:role:{user_id}")
+        if cached is not None:
+            role = cached.decode('utf-8')
+    if role is None:
+        user = current_user()
+        role = user.role or '' if user is not None else DELETED_USER_ROLE
+        if redis_client is not None:
+            redis_client.set(f"user:role:{user_id}", role, ex=USER_ROLE_TTL, nx=True)
+    if role == DELETED_USER_ROLE:
+        session.clear()
+        return None
+    if (session.get('role') or '') != role:
+        session['role'] = role  # keep role-dependent UI in step
+    return role
 
 def login_required(f):
-    from functools import wraps
     @wraps(f)
     def wrapped(*args, **kwargs):
-        if 'user_id' not in session:
-            return redirect(url_for('login'))
+        if current_role() is None:
+            return redirect(static_url('login'))
         return f(*args, **kwargs)
     return wrapped
 
 def admin_required(f):
-    from functools import wraps
     @wraps(f)
     def wrapped(*args, **kwargs):
-        if 'user_id' not in session:
-            return redirect(url_for('login'))
-        user = get_user_by_id(session['user_id'])
-        if not user or user.role != 'admin':
+        role = current_role()
+        if role is None:
+            return redirect(static_url('login'))
+        if role != 'admin':
             flash("Bạn không có quyền truy cập (cần admin).", "danger")
-            return redirect(url_for('index'))
+            return redirect(static_url('index'))
         return f(*args, **kwargs)
     return wrapped
 
@@ -76,17 +315,18 @@ def admin_required(f):
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
-        username = request.form.get('username','').strip()
-        password = request.form.get('password','')
+        form = request.form
+        username = clean(form.get('username',''))
+        password = form.get('password','')
         user = get_user_by_username(username)
-        if user:
-            # SIMPLE CHECK: plaintext comparison
-            if password == user.password:
-                session['user_id'] = user.id
-                session['username'] = user.username
-                session['role'] = user.role
-                flash("Đăng nhập thành công.", "success")
-                return redirect(url_for('index'))
+        if verify_password(user, password):
+            if db_session.is_modified(user):
+                db_session.commit()
+            session['user_id'] = user.id
+            session['username'] = user.username
+            session['role'] = user.role
+            flash("Đăng nhập thành công.", "success")
+            return redirect(url_for('index'))
         flash("Sai username hoặc password.", "danger")
     return render_template('login.html')
 
@@ -106,18 +346,38 @@ def index():
 @app.route('/notifications')
 @login_required
 def notifications():
-    with OrmSession(engine) as s:
-        stmt = select(Notification).order_by(Notification.id.desc())
-        notifications = s.scalars(stmt).all()
-    return render_template('notifications.html', notifications=notifications)
+    version = notifications_version()
+    etag = None
+    # pending flash messages are part of the page, so never answer 304 then
+    if version is not None and '_flashes' not in session:
+        # the page also shows the viewer's name and role-specific controls
+        viewer = f"{version}:{session['user_id']}:{session.get('username')}:{session.get('role')}"
+        etag = hashlib.blake2b(viewer.encode('utf-8'), digest_size=8).hexdigest()
+        if request.if_none_match.contains(etag):
+            resp = app.response_class(status=304)
+            resp.set_etag(etag)
+            return resp
+    after, limit = page_args()
+    # The session is saved before a streamed body is sent, so consume the
+    # flashes now; the template then reads them from the request cache.
+    get_flashed_messages()
+    resp = app.response_class(stream_template(
+        'notifications.html',
+        notifications=iter_notifications_page(after, limit, version),
+        after=after, limit=limit))
+    if etag is not None:
+        resp.set_etag(etag)
+        resp.cache_control.private = True
+        resp.cache_control.max_age = 0
+        resp.cache_control.must_revalidate = True
+    return resp
 
 @app.route('/notifications/<int:notification_id>')
 @login_required
 def notification_detail(notification_id):
-    with OrmSession(engine) as s:
-        stmt = select(Notification).where(Notification.id == notification_id)
-        notif = s.scalar(stmt)
-    if not notif:
+    notif = fetch_one(select(Notification.id, Notification.content, Notification.note)
+                      .where(Notification.id == notification_id))
+    if notif is None:
         abort(404)
     return render_template('notification_detail.html', notif=notif)
 
@@ -126,12 +386,12 @@ def notification_detail(notification_id):
 @admin_required
 def notification_add():
     if request.method == 'POST':
-        content = request.form.get('content','').strip()
-        note = request.form.get('note','').strip()
-        with OrmSession(engine) as s:
-            n = Notification(content=content, note=note)
-            s.add(n)
-            s.commit()
+        form = request.form
+        content = clean(form.get('content',''))
+        note = clean(form.get('note',''))
+        db_session.add(Notification(content=content, note=note))
+        db_session.commit()
+        invalidate_notifications_cache()
         flash("Thông báo đã được thêm.", "success")
         return redirect(url_for('notifications'))
     return render_template('notification_form.html', action="Thêm", notif=None)
@@ -139,28 +399,34 @@ def notification_add():
 @app.route('/notifications/edit/<int:notification_id>', methods=['GET', 'POST'])
 @admin_required
 def notification_edit(notification_id):
-    with OrmSession(engine) as s:
-        n = s.get(Notification, notification_id)
-        if not n:
+    if request.method == 'POST':
+        form = request.form
+        stmt = (update(Notification)
+                .where(Notification.id == notification_id)
+                .values(content=clean(form.get('content','')), note=clean(form.get('note','')))
+                .execution_options(synchronize_session=False))
+        if db_session.execute(stmt).rowcount == 0:
             abort(404)
-        if request.method == 'POST':
-            n.content = request.form.get('content','').strip()
-            n.note = request.form.get('note','').strip()
-            s.add(n)
-            s.commit()
-            flash("Thông báo đã được cập nhật.", "success")
-            return redirect(url_for('notifications'))
+        db_session.commit()
+        invalidate_notifications_cache()
+        flash("Thông báo đã được cập nhật.", "success")
+        return redirect(url_for('notifications'))
+    n = fetch_one(select(Notification.id, Notification.content, Notification.note)
+                  .where(Notification.id == notification_id))
+    if n is None:
+        abort(404)
     return render_template('notification_form.html', action="Sửa", notif=n)
 
 @app.route('/notifications/delete/<int:notification_id>', methods=['POST'])
 @admin_required
 def notification_delete(notification_id):
-    with OrmSession(engine) as s:
-        n = s.get(Notification, notification_id)
-        if not n:
-            abort(404)
-        s.delete(n)
-        s.commit()
+    stmt = (delete(Notification)
+            .where(Notification.id == notification_id)
+            .execution_options(synchronize_session=False))
+    if db_session.execute(stmt).rowcount == 0:
+        abort(404)
+    db_session.commit()
+    invalidate_notifications_cache()
     flash("Thông báo đã bị xóa.", "warning")
     return redirect(url_for('notifications'))
 
@@ -168,17 +434,23 @@ def notification_delete(notification_id):
 @app.route('/users')
 @admin_required
 def users():
-    with OrmSession(engine) as s:
-        stmt = select(User).order_by(User.id)
-        users = s.scalars(stmt).all()
-    return render_template('users.html', users=users)
+    after, limit = page_args()
+    # never pull password hashes (or long descriptions) into the list page
+    stmt = (select(User)
+            .options(load_only(User.id, User.username, User.role))
+            .order_by(User.id).limit(limit))
+    if after is not None:
+        stmt = stmt.where(User.id > after)
+    users = db_session.scalars(stmt).all()
+    next_after = users[-1].id if len(users) == limit else None
+    return render_template('users.html', users=users,
+                           after=after, next_after=next_after, limit=limit)
 
 @app.route('/users/<int:user_id>')
 @login_required
 def user_detail(user_id):
-    with OrmSession(engine) as s:
-        u = s.get(User, user_id)
-    if not u:
+    u = fetch_one(select(*USER_DISPLAY_COLUMNS).where(User.id == user_id))
+    if u is None:
         abort(404)
     return render_template('user_detail.html', user=u)
 
@@ -186,20 +458,23 @@ def user_detail(user_id):
 @admin_required
 def user_add():
     if request.method == 'POST':
-        username = request.form.get('username','').strip()
-        password = request.form.get('password','')
-        fullname = request.form.get('fullname','').strip()
-        description = request.form.get('description','').strip()
-        role = request.form.get('role','user')
-        with OrmSession(engine) as s:
-            # check unique username
-            exists = s.scalar(select(User).where(User.username==username))
-            if exists:
-                flash("Username đã tồn tại.", "danger")
-                return render_template('user_form.html', action="Thêm", user=None)
-            u = User(username=username, password=password, fullname=fullname, description=description, role=role)
-            s.add(u)
-            s.commit()
+        form = request.form
+        username = clean(form.get('username',''))
+        password = form.get('password','')
+        fullname = clean(form.get('fullname',''))
+        description = clean(form.get('description',''))
+        role = form.get('role','user')
+        # unique username is enforced by the INSERT itself (no SELECT first, no race)
+        stmt = (pg_insert(User)
+                .values(username=username, password=hash_password(password), fullname=fullname, description=description, role=role)
+                .on_conflict_do_nothing(index_elements=[User.username])
+                .returning(User.id))
+        created = db_session.execute(stmt).first()
+        db_session.commit()
+        if created is None:
+            flash("Username đã tồn tại.", "danger")
+            return render_template('user_form.html', action="Thêm", user=None)
+        set_user_role(created.id, role)
         flash("Người dùng đã được thêm.", "success")
         return redirect(url_for('users'))
     return render_template('user_form.html', action="Thêm", user=None)
@@ -207,21 +482,29 @@ def user_add():
 @app.route('/users/edit/<int:user_id>', methods=['GET', 'POST'])
 @admin_required
 def user_edit(user_id):
-    with OrmSession(engine) as s:
-        u = s.get(User, user_id)
-        if not u: abort(404)
-        if request.method == 'POST':
-            u.username = request.form.get('username','').strip()
-            new_password = request.form.get('password','')
-            if new_password:
-                u.password = new_password
-            u.fullname = request.form.get('fullname','').strip()
-            u.description = request.form.get('description','').strip()
-            u.role = request.form.get('role','user')
-            s.add(u)
-            s.commit()
-            flash("Người dùng đã được cập nhật.", "success")
-            return redirect(url_for('users'))
+    if request.method == 'POST':
+        form = request.form
+        values = dict(
+            username=clean(form.get('username','')),
+            fullname=clean(form.get('fullname','')),
+            description=clean(form.get('description','')),
+            role=form.get('role','user'),
+        )
+        new_password = form.get('password','')
+        if new_password:
+            values['password'] = hash_password(new_password)
+        stmt = (update(User)
+                .where(User.id == user_id)
+                .values(**values)
+                .execution_options(synchronize_session=False))
+        if db_session.execute(stmt).rowcount == 0:
+            abort(404)
+        db_session.commit()
+        set_user_role(user_id, values['role'])
+        flash("Người dùng đã được cập nhật.", "success")
+        return redirect(url_for('users'))
+    u = fetch_one(select(*USER_DISPLAY_COLUMNS).where(User.id == user_id))
+    if u is None: abort(404)
     return render_template('user_form.html', action="Sửa", user=u)
 
 @app.route('/users/delete/<int:user_id>', methods=['POST'])
@@ -231,11 +514,13 @@ def user_delete(user_id):
     if session.get('user_id') == user_id:
         flash("Bạn không thể xóa chính mình.", "danger")
         return redirect(url_for('users'))
-    with OrmSession(engine) as s:
-        u = s.get(User, user_id)
-        if not u: abort(404)
-        s.delete(u)
-        s.commit()
+    stmt = (delete(User)
+            .where(User.id == user_id)
+            .execution_options(synchronize_session=False))
+    if db_session.execute(stmt).rowcount == 0:
+        abort(404)
+    db_session.commit()
+    set_user_role(user_id, DELETED_USER_ROLE)
     flash("Người dùng đã bị xóa.", "warning")
     return redirect(url_for('users'))
 
@@ -251,4 +536,5 @@ if __name__ == '__main__':
             pass
     except OperationalError as e:
         print("Kết nối DB thất bại:", e)
+    enable_lazyload_guard()
     app.run(debug=True)
@@ -0,0 +1,14 @@
+# gunicorn.conf.py
+# Picked up automatically by `gunicorn app:app` (see Procfile).
+import os
+
+# gevent workers: a request blocked on Postgres yields to the others instead
+# of holding the whole worker. psycopg 3 is gevent-aware once monkey-patched,
+# so no extra green patching of the driver is needed.
+worker_class = 'gevent'
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', '100'))
+# Keep the app import inside each worker, after gevent has patched it: a
+# preloaded app would build its engine pool and request-scoped session
+# registry before threading is green, sharing them across greenlets.
+preload_app = False